@@ -4,6 +4,11 @@ from wtforms.validators import DataRequired, URL
 from flask_ckeditor import CKEditorField
 
 
+# emails are stored and looked up lowercased, so the unique index on user_details.email matches any casing
+def normalize_email(email):
+    return email.strip().lower() if email else email
+
+
 # # WTForm
 class CreatePostForm(FlaskForm):
     title = StringField("Blog Post Title", validators=[DataRequired()])
@@ -16,7 +21,7 @@ class CreatePostForm(FlaskForm):
 # # register form
 class RegisterForm(FlaskForm):
     name = StringField("Your Name", validators=[DataRequired()])
-    email = EmailField("Email", validators=[DataRequired()])
+    email = EmailField("Email", validators=[DataRequired()], filters=[normalize_email])
     password = PasswordField("Password", validators=[DataRequired()])
     confirm_password = PasswordField("Confirm Password", validators=[DataRequired()])
     submit = SubmitField("Add me to the Family")
@@ -24,7 +29,7 @@ class RegisterForm(FlaskForm):
 
 # # Login form
 class LoginForm(FlaskForm):
-    email = EmailField("Email", validators=[DataRequired()])
+    email = EmailField("Email", validators=[DataRequired()], filters=[normalize_email])
     password = PasswordField("Password", validators=[DataRequired()])
     submit = SubmitField("Let me in")
 
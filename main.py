@@ -1,21 +1,48 @@
-from flask import Flask, render_template, redirect, url_for, flash, abort, request
+from flask import Flask, render_template, redirect, url_for, flash, abort, request, make_response, session, g
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
-from datetime import date
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_caching import Cache
+from datetime import date, datetime
+from functools import wraps, lru_cache
+from hashlib import blake2b
+import time
+from werkzeug.security import check_password_hash
+import bcrypt
+import bleach
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
+from sqlalchemy import event, func, lambda_stmt, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+import sqlite3
+from sqlalchemy.orm import relationship, joinedload, selectinload
 from flask_login import UserMixin, login_user, LoginManager, login_required, current_user, logout_user
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
 from flask_gravatar import Gravatar
 import os
 from dotenv import load_dotenv, find_dotenv
-from smtplib import SMTP_SSL
+from jinja2 import FileSystemBytecodeCache
+from smtplib import SMTP_SSL, SMTPException
+from queue import Queue, Empty
+from celery import Celery
 
 load_dotenv(find_dotenv())
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY")
+# let browsers keep css/js/images for half a day instead of revalidating them on every page
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 43200
+
+# share compiled templates between workers and restarts, and stop checking template mtimes outside development
+# jinja's default directory is private to this uid and ownership checked, so only override it when asked to
+if os.getenv("JINJA_CACHE_DIR"):
+    os.makedirs(os.getenv("JINJA_CACHE_DIR"), mode=0o700, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory=os.getenv("JINJA_CACHE_DIR"))
+else:
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+if os.getenv("FLASK_ENV") != "development":
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+    app.jinja_env.auto_reload = False
+
 ckeditor = CKEditor(app)
 Bootstrap(app)
 
@@ -24,8 +51,41 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("DATABASE_URL", "sqlite:///blo
 if app.config['SQLALCHEMY_DATABASE_URI'] and app.config['SQLALCHEMY_DATABASE_URI'].startswith("postgres://"):
     app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_DATABASE_URI'].replace("postgres://", "postgresql://", 1)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith("sqlite:///"):
+    # pool the local sqlite connections across worker threads instead of reopening the file per request
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "poolclass": QueuePool,
+        "connect_args": {"check_same_thread": False},
+    }
 db = SQLAlchemy(app)
 
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers keep going while a post or comment is being written
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-64000")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+
+
+celery = Celery('aries', broker=os.getenv("REDIS_URL"))
+# without a broker there is no worker to hand the mail to, so run the task inside the request as before
+celery.conf.task_always_eager = not os.getenv("REDIS_URL")
+celery.conf.task_eager_propagates = True
+
+POSTS_PER_PAGE = 10
+
+# the rendered pages have to be dropped from every gunicorn worker when a post changes, which only a shared
+# Redis cache can do, so without one the page cache is switched off rather than left serving stale pages
+cache = Cache(app, config={
+    'CACHE_TYPE': 'RedisCache' if os.getenv("REDIS_URL") else 'NullCache',
+    'CACHE_REDIS_URL': os.getenv("REDIS_URL"),
+})
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 
@@ -36,7 +96,11 @@ gravatar = Gravatar(app,
                     force_default=False,
                     force_lower=False,
                     use_ssl=False,
-                    base_url=None)
+                    base_url=os.getenv("GRAVATAR_BASE_URL"))
+
+# the avatar url only depends on the email, so hash each address once instead of on every render
+gravatar_url_for = lru_cache(maxsize=4096)(gravatar)
+app.jinja_env.globals['gravatar_url'] = gravatar_url_for
 
 # # CONFIGURE TABLES
 
@@ -62,9 +126,11 @@ class BlogPost(db.Model):
 
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    date = db.Column(db.Date, nullable=False, index=True)
     body = db.Column(db.Text, nullable=False)
+    body_html = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     blog_comments = relationship("Comment", back_populates="blog")
 
@@ -74,65 +140,220 @@ class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     comment = db.Column(db.Text, nullable=False)
 
-    user_id = db.Column(db.Integer, db.ForeignKey("user_details.id"))
+    user_id = db.Column(db.Integer, db.ForeignKey("user_details.id"), index=True)
     user = relationship("User", back_populates="user_comments")
 
-    blog_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"))
+    blog_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"), index=True)
     blog = relationship("BlogPost", back_populates="blog_comments")
 
 
 # db.create_all()
 
 
-def send_mail(name, email, number, message):
+# markup allowed through to the rendered post, any other tag is stripped and only its text is kept
+ALLOWED_TAGS = [
+    "a", "abbr", "b", "blockquote", "br", "caption", "code", "div", "em", "figcaption", "figure", "h1", "h2",
+    "h3", "h4", "h5", "h6", "hr", "i", "img", "li", "ol", "p", "pre", "s", "span", "strong", "sub", "sup",
+    "table", "tbody", "td", "tfoot", "th", "thead", "tr", "u", "ul",
+]
+ALLOWED_ATTRIBUTES = {
+    "*": ["style"],
+    "a": ["href", "title", "target"],
+    "img": ["src", "alt", "width", "height"],
+    "table": ["border", "cellpadding", "cellspacing", "summary"],
+    "th": ["colspan", "rowspan", "scope"],
+    "td": ["colspan", "rowspan"],
+}
+# CKEditor sizes images and tables and aligns text through inline styles
+ALLOWED_STYLES = [
+    "width", "height", "float", "text-align", "vertical-align", "margin", "margin-left", "margin-right",
+    "border", "border-width", "border-style", "border-color", "color", "background-color",
+]
+
+
+def render_body(body):
+    # sanitised once when the post is saved, show_post just serves the stored html
+    return bleach.clean(body, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES, styles=ALLOWED_STYLES, strip=True)
+
+
+@app.cli.command("backfill-body-html")
+def backfill_body_html():
+    """Re-render body_html from body for every post, after adding the column or changing the allow-lists."""
+    posts = BlogPost.query.all()
+    for post in posts:
+        post.body_html = render_body(post.body)
+    db.session.commit()
+    print(f"Rendered body_html for {len(posts)} posts")
+
+
+# logged-in SMTP sessions kept warm between mails, so each send skips the TCP + TLS + AUTH round trips
+_smtp_pool = Queue()
+
+
+def smtp_connection():
+    connection = SMTP_SSL("smtp.gmail.com")
+    connection.login(
+        user=os.getenv("EMAIL"),
+        password=os.getenv("PASSWORD"),
+    )
+    return connection
+
+
+def pooled_smtp_connection():
+    # gmail closes idle sessions with a 421 or just drops the socket, so make sure a pooled one still answers
+    while True:
+        try:
+            connection = _smtp_pool.get_nowait()
+        except Empty:
+            return smtp_connection()
+        try:
+            if connection.noop()[0] == 250:
+                return connection
+        except (SMTPException, OSError):
+            pass
+        connection.close()
+
+
+@celery.task(bind=True, max_retries=3)
+def send_mail(self, name, email, number, message):
     message = f"subject:You got a message\n\nName : {name}\nEmail : {email}\nPhone Number : {number}\nMessage : {message}"
-    with SMTP_SSL("smtp.gmail.com") as connection:
+    connection = None
+    try:
+        connection = pooled_smtp_connection()
+        connection.sendmail(from_addr=os.getenv("EMAIL"), to_addrs=os.getenv("EMAIL"), msg=message)
+    except (SMTPException, OSError) as error:
+        if connection is not None:
+            connection.close()
+        raise self.retry(exc=error, countdown=60)
 
-        connection.login(
-            user=os.getenv("EMAIL"),
-            password=os.getenv("PASSWORD"),
-        )
-        connection.sendmail(
-            from_addr=os.getenv("EMAIL"),
-            to_addrs=os.getenv("EMAIL"),
-            msg=message
-        )
+    _smtp_pool.put(connection)
+
+
+def hash_password(password):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=12)).decode()
+
+
+def verify_password(pwhash, password):
+    # accounts registered before the switch to bcrypt still carry werkzeug pbkdf2 hashes
+    if pwhash.startswith("pbkdf2:"):
+        return check_password_hash(pwhash=pwhash, password=password)
+    return bcrypt.checkpw(password.encode(), pwhash.encode())
+
+
+# checked against when there is no real hash to compare, so every branch pays for one bcrypt round
+_DUMMY_HASH = hash_password("x" * 16)
 
 
 def admin_only(function):
+    @wraps(function)
     def my_wrapper_function(*args, **kwargs):
-        if current_user.get_id() == "1":
+        if getattr(current_user, "id", None) == 1:
             return function(*args, **kwargs)
         else:
             return abort(403)
 
-    my_wrapper_function.__name__ = function.__name__
-
     return my_wrapper_function
 
 
+def csrf_window():
+    # a rendered CSRF token expires WTF_CSRF_TIME_LIMIT seconds after it was signed, so pages with a form
+    # get a new tag every half limit and a cached form always has at least half its token lifetime left
+    time_limit = app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    if time_limit is None:
+        return None
+    return int(time.time() // (time_limit / 2))
+
+
+def etag_cached(etag_source, has_form=False):
+    # etag_source returns a cheap summary of the rows a page renders, so a repeat GET
+    # with a matching If-None-Match gets a 304 without running the view at all.
+    def decorator(function):
+        @wraps(function)
+        def my_wrapper_function(*args, **kwargs):
+            if request.method != "GET":
+                return function(*args, **kwargs)
+
+            # the page also depends on who is looking at it and on the CSRF token baked into its forms
+            state = (current_user.get_id(), session.get("csrf_token"), etag_source(*args, **kwargs))
+            if has_form:
+                state += (csrf_window(),)
+            etag = blake2b(repr(state).encode(), digest_size=16).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+            else:
+                response = make_response(function(*args, **kwargs))
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
+
+        return my_wrapper_function
+
+    return decorator
+
+
+def requested_page():
+    # paginate treats page 0 and negative pages as page 1, so key the cache the same way
+    return max(1, request.args.get('page', 1, type=int))
+
+
+def index_cache_key(page):
+    # keyed by the same aggregates as the ETag, so a write moves readers to a fresh key and a new tag is
+    # never paired with a page rendered before that write
+    version = blake2b(repr(all_posts_etag()).encode(), digest_size=8).hexdigest()
+    return f"index/{page}/{version}"
+
+
+def all_posts_etag():
+    # computed once per request so the ETag and the page cache key always see the same version
+    if "all_posts_etag" not in g:
+        g.all_posts_etag = tuple(db.session.query(
+            func.count(BlogPost.id),
+            func.max(BlogPost.id),
+            func.max(BlogPost.updated_at),
+        ).one())
+    return g.all_posts_etag
+
+
+def post_etag(post_id):
+    return db.session.query(
+        BlogPost.updated_at,
+        func.count(Comment.id),
+        func.max(Comment.id),
+    ).outerjoin(Comment, Comment.blog_id == BlogPost.id).filter(BlogPost.id == post_id).group_by(BlogPost.id).first()
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # keep loaded users on g so repeat lookups in the same request skip the session entirely
+    loaded_users = g.setdefault("loaded_users", {})
+    if user_id not in loaded_users:
+        loaded_users[user_id] = db.session.get(User, int(user_id))
+    return loaded_users[user_id]
+
+
+def user_by_email(email):
+    # lambda_stmt caches the compiled SELECT, only the email is bound per call
+    return db.session.execute(lambda_stmt(lambda: select(User).where(User.email == email))).scalars().first()
 
 
 @app.route('/')
+@etag_cached(all_posts_etag)
+@cache.cached(timeout=60, key_prefix=lambda: index_cache_key(requested_page()),
+              unless=lambda: current_user.is_authenticated)
 def get_all_posts():
-    posts = BlogPost.query.all()
-    return render_template("index.html", all_posts=posts)
+    pagination = BlogPost.query.options(joinedload(BlogPost.author)).order_by(
+        BlogPost.date.desc(), BlogPost.id.desc()
+    ).paginate(page=requested_page(), per_page=POSTS_PER_PAGE, error_out=False)
+    return render_template("index.html", all_posts=pagination.items, pagination=pagination)
 
 
 @app.route('/register', methods=["GET", "POST"])
 def register():
     register_form = RegisterForm()
     if register_form.validate_on_submit():
-        if User.query.filter_by(email=register_form.email.data).first() is None:
+        if user_by_email(register_form.email.data) is None:
             if register_form.password.data == register_form.confirm_password.data:
-                hash_and_salted_pass = generate_password_hash(
-                    password=register_form.password.data,
-                    method='pbkdf2:sha256',
-                    salt_length=8,
-                )
+                hash_and_salted_pass = hash_password(register_form.password.data)
                 new_user = User(
                     name=register_form.name.data,
                     email=register_form.email.data,
@@ -146,8 +367,10 @@ def register():
 
                 return redirect(url_for("get_all_posts"))
             else:
+                verify_password(pwhash=_DUMMY_HASH, password=register_form.password.data)
                 flash("Check the password you have re-entered")
         else:
+            verify_password(pwhash=_DUMMY_HASH, password=register_form.password.data)
             flash("Your Email is already registered, Try logging in")
             return redirect(url_for("login"))
 
@@ -158,9 +381,12 @@ def register():
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
+        user = user_by_email(form.email.data)
         if user:
-            if check_password_hash(pwhash=user.password, password=form.password.data):
+            if verify_password(pwhash=user.password, password=form.password.data):
+                if user.password.startswith("pbkdf2:"):
+                    user.password = hash_password(form.password.data)
+                    db.session.commit()
 
                 login_user(user)
 
@@ -168,6 +394,7 @@ def login():
             else:
                 flash("Check the password you have entered")
         else:
+            verify_password(pwhash=_DUMMY_HASH, password=form.password.data)
             flash("This email doesn't, Try registering first")
 
     return render_template("login.html", form=form)
@@ -180,15 +407,19 @@ def logout():
 
 
 @app.route("/post/<int:post_id>", methods=["GET", "POST"])
+@etag_cached(post_etag, has_form=True)
 def show_post(post_id):
-    requested_post = BlogPost.query.get(post_id)
+    requested_post = db.session.get(BlogPost, post_id, options=[
+        joinedload(BlogPost.author),
+        selectinload(BlogPost.blog_comments).joinedload(Comment.user),
+    ])
     form = CommentForm()
     if form.validate_on_submit():
         if not current_user.is_anonymous:
             new_comment = Comment(
                 comment=form.comment.data,
                 user=current_user,
-                blog=BlogPost.query.get(post_id),
+                blog_id=post_id,
             )
             db.session.add(new_comment)
             db.session.commit()
@@ -201,6 +432,7 @@ def show_post(post_id):
 
 
 @app.route("/about")
+@cache.cached(timeout=300, unless=lambda: current_user.is_authenticated)
 def about():
     return render_template("about.html")
 
@@ -213,7 +445,7 @@ def contact():
         number = request.form["number"]
         message = request.form["text"]
 
-        send_mail(name, email, number, message)
+        send_mail.delay(name, email, number, message)
 
         flash("Your message is sent successfully")
 
@@ -231,9 +463,10 @@ def add_new_post():
             title=form.title.data,
             subtitle=form.subtitle.data,
             body=form.body.data,
+            body_html=render_body(form.body.data),
             author=current_user,
             img_url=form.img_url.data,
-            date=date.today().strftime("%B %d, %Y")
+            date=date.today()
         )
         db.session.add(new_post)
         db.session.commit()
@@ -244,7 +477,7 @@ def add_new_post():
 @app.route("/edit-post/<int:post_id>", methods=["GET", "POST"])
 @admin_only
 def edit_post(post_id):
-    post = BlogPost.query.get(post_id)
+    post = db.session.get(BlogPost, post_id)
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
@@ -256,6 +489,7 @@ def edit_post(post_id):
         post.subtitle = edit_form.subtitle.data
         post.img_url = edit_form.img_url.data
         post.body = edit_form.body.data
+        post.body_html = render_body(edit_form.body.data)
         db.session.commit()
         return redirect(url_for("show_post", post_id=post.id))
 
@@ -265,7 +499,7 @@ def edit_post(post_id):
 @app.route("/delete/<int:post_id>")
 @admin_only
 def delete_post(post_id):
-    post_to_delete = BlogPost.query.get(post_id)
+    post_to_delete = db.session.get(BlogPost, post_id)
     db.session.delete(post_to_delete)
     db.session.commit()
     return redirect(url_for('get_all_posts'))